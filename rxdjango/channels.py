@@ -2,7 +2,6 @@ import json
 from collections import deque, namedtuple
 import pymongo
 from django.utils import timezone
-from hashlib import md5
 from asgiref.sync import async_to_sync
 from django.conf import settings
 from django.db import models, connection, transaction, ProgrammingError
@@ -14,6 +13,7 @@ from .websocket_router import WebsocketRouter
 from .signal_handler import SignalHandler
 from .redis import RedisStateSession
 from .mongo import MongoStateSession
+from .state_loader import StateLoader
 
 
 class ContextChannelMeta(type):
@@ -139,6 +139,24 @@ class ContextChannel(metaclass=ContextChannelMeta):
             await mongo.clear()
         return result
 
+    @classmethod
+    async def prewarm(cls, anchor_id):
+        """Build the cache for an anchor before any client connects,
+        so that the first client gets a HOT state instead of COLD"""
+        # No user is involved, instances of all users are cached
+        channel = cls.__new__(cls)
+        channel.kwargs = {}
+        channel.user = None
+        channel.user_id = None
+        channel.anchor_id = anchor_id
+
+        async with StateLoader(channel) as loader:
+            # Only COLD and COOLING states are loaded by this session,
+            # HEATING is loaded by another session and HOT is ready
+            if loader.cache_state in (0, 3):
+                async for instances in loader.list_instances():
+                    pass
+
     @classmethod
     def broadcast_instance(cls, anchor_id, instance, operation='update'):
         cls._signal_handler.broadcast_instance(anchor_id, instance, operation)
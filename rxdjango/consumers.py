@@ -10,7 +10,7 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from rest_framework.authtoken.models import Token
 from .state_loader import StateLoader
 from .exceptions import UnauthorizedError, ForbiddenError, AnchorDoesNotExist
-from rxdjango.serialize import json_dumps
+from rxdjango.serialize import json_dumps, json_loads
 
 
 class StateConsumer(AsyncWebsocketConsumer):
@@ -43,7 +43,7 @@ class StateConsumer(AsyncWebsocketConsumer):
 
     async def receive_authentication(self, text_data):
         # If user is not logged, we expect credentials
-        data = json.loads(text_data)
+        data = json_loads(text_data)
         token = data.get('token', None)
         last_update  = data.get('last_update', None)
 
@@ -120,7 +120,8 @@ class StateConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def authenticate(self, token):
         try:
-            token = Token.objects.get(key=token)
+            # The user is always needed, fetch it in the same query
+            token = Token.objects.select_related('user').get(key=token)
         except Token.DoesNotExist:
             raise UnauthorizedError('error/unauthorized')
             return
@@ -136,14 +137,17 @@ class StateConsumer(AsyncWebsocketConsumer):
 
         return token.user
 
-    async def relay(self, payload):
-        payload = payload['payload']
-        await self.send(text_data=json_dumps(payload))
+    async def relay(self, message):
+        # Instance updates come already encoded, system messages don't
+        text = message.get('text')
+        if text is None:
+            text = json_dumps(message['payload'])
+        await self.send(text_data=text)
 
     async def receive_command(self, text_data):
         # If user is logged, we expect a JSON command
         try:
-            data = json.loads(text_data)
+            data = json_loads(text_data)
         except json.JSONDecodeError:
             await self.disconnect()
         await self.channel.receive(data)
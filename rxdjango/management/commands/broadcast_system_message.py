@@ -1,7 +1,6 @@
 import sys
 import asyncio
 from django.core.management.base import BaseCommand
-from rxdjango.sdk import make_sdk
 from rxdjango.websocket_router import send_system_message
 
 
@@ -1,5 +1,4 @@
 from daphne.management.commands.runserver import Command as RunserverCommand
-from rxdjango.sdk import make_sdk
 
 class Command(RunserverCommand):
 
@@ -10,5 +9,7 @@ class Command(RunserverCommand):
 
     def inner_run(self, *args, **kwargs):
         if kwargs['makefrontend']:
+            # Codegen modules are only loaded when needed
+            from rxdjango.sdk import make_sdk
             make_sdk()
         super().inner_run(*args, **kwargs)
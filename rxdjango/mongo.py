@@ -1,14 +1,21 @@
-import json
+import asyncio
+import os
 from datetime import datetime
 from copy import copy
 from decimal import Decimal
+from functools import lru_cache
 import pymongo
 import gridfs
 from motor import motor_asyncio
 from django.db import ProgrammingError
 from django.conf import settings
+from django.utils.functional import cached_property
 from .redis import get_tstamp, sync_get_tstamp
-from .serialize import json_dumps
+from .serialize import json_dumpb, json_loads
+
+
+# Fields of cached documents that are not sent to clients
+_LIST_PROJECTION = {'_id': False, '_anchor_id': False}
 
 
 class MongoStateSession:
@@ -20,9 +27,20 @@ class MongoStateSession:
         self.state_model = channel._state_model
         self._tstamp = None
 
-        client = motor_asyncio.AsyncIOMotorClient(settings.MONGO_URL)
-        self.db = client[settings.MONGO_STATE_DB]
-        self.collection = self.db[channel.__class__.__name__.lower()]
+    @cached_property
+    def db(self):
+        # Bound to the loop of the first query, not the one (if any)
+        # running when the session is built
+        return _async_client()[settings.MONGO_STATE_DB]
+
+    @cached_property
+    def collection(self):
+        return self.db[self.channel.__class__.__name__.lower()]
+
+    @cached_property
+    def fs(self):
+        # Same "fs" bucket MongoSignalWriter.fs writes large instances to
+        return motor_asyncio.AsyncIOMotorGridFSBucket(self.db)
 
     async def tstamp(self):
         if self._tstamp:
@@ -40,18 +58,17 @@ class MongoStateSession:
                 '_deleted': {'$ne': True},
             }
 
-            async for instance in self.collection.find(query):
+            cursor = self.collection.find(query, _LIST_PROJECTION)
+            async for instance in cursor:
                 try:
                     grid_ref = instance['_grid_ref']
                 except KeyError:
                     pass
                 else:
-                    fs = gridfs.GridFS(self.db)
-                    serialized = fs.get(grid_ref)
-                    instance = json.loads(serialized.decode())
-
-                del instance['_id']
-                del instance['_anchor_id']
+                    stream = await self.fs.open_download_stream(grid_ref)
+                    instance = json_loads(await stream.read())
+                    # Large instances are stored whole in GridFS
+                    instance.pop('_anchor_id', None)
 
                 instances.append(instance)
 
@@ -60,22 +77,26 @@ class MongoStateSession:
                 instances = []
 
     async def write_instances(self, instances):
+        requests = []
         for instance in instances:
             instance = _adapt(instance)
             instance['_anchor_id'] = self.anchor_id
             instance_type = instance['_instance_type']
             if instance.get('id', None) is None:
                 raise ProgrammingError(f'Instance type {instance_type} has no "id"')
-            instance = _adapt(instance)
-            await self.collection.replace_one(
+            requests.append(pymongo.ReplaceOne(
                 {
                     '_anchor_id': self.anchor_id,
-                    '_instance_type': instance['_instance_type'],
+                    '_instance_type': instance_type,
                     'id': instance['id'],
                 },
                 instance,
                 upsert=True,
-            )
+            ))
+
+        # Ordered, so that a repeated instance keeps its last version
+        if requests:
+            await self.collection.bulk_write(requests)
 
     async def clear(self):
         query = {'_anchor_id': self.anchor_id}
@@ -84,20 +105,26 @@ class MongoStateSession:
 
 class MongoSignalWriter:
     def __init__(self, channel_class):
-        # Make a new connection, because this needs to be sync
-        client = pymongo.MongoClient(settings.MONGO_URL)
-        self.db = client[settings.MONGO_STATE_DB]
+        # Sync client, because this runs inside signal handlers
+        self.db = _sync_client(settings.MONGO_URL)[settings.MONGO_STATE_DB]
         self.collection = self.db[channel_class.__name__.lower()]
 
+    @cached_property
+    def fs(self):
+        return gridfs.GridFS(self.db)
+
     def init_database(self):
         self.collection.drop()
 
+        # Writes look up (_anchor_id, _instance_type, id) and state
+        # loading filters (_anchor_id, _instance_type, _user_key), so
+        # _user_key goes last to keep both on an index range
         self.collection.create_index(
             [
                 ('_anchor_id', pymongo.ASCENDING),
-                ('_user_key', pymongo.ASCENDING),
                 ('_instance_type', pymongo.ASCENDING),
                 ('id', pymongo.ASCENDING),
+                ('_user_key', pymongo.ASCENDING),
             ],
             name='instance_pkey',
         )
@@ -132,9 +159,8 @@ class MongoSignalWriter:
                     del original['_id']
             except pymongo.errors.DocumentTooLarge:
                 original = None
-                data = json_dumps(instance).encode()
-                fs = gridfs.GridFS(self.db)
-                grid_ref = fs.put(data)
+                data = json_dumpb(instance)
+                grid_ref = self.fs.put(data)
 
                 instance = {
                     '_anchor_id': anchor_id,
@@ -167,11 +193,12 @@ class MongoSignalWriter:
                         # an incomplete serialized object.
                         # TODO emit a warning
                         continue
-                    if isinstance(new_value, list):
-                        old_value = set(old_value)
-                        new_value = set(new_value)
                     if new_value == old_value:
                         del instance[key]
+                    elif isinstance(new_value, list) and \
+                         set(new_value) == set(old_value):
+                        # Same related ids in a different order
+                        del instance[key]
                     else:
                         empty = False
 
@@ -181,6 +208,39 @@ class MongoSignalWriter:
         return deltas
 
 
+def _async_client():
+    # A motor client can't be used across event loops, so each loop
+    # keeps its own, and every MongoStateSession in it reuses that pool
+    key = (os.getpid(), asyncio.get_running_loop())
+    client = _async_clients.get(key)
+    if client is None:
+        _discard_stale_clients()
+        client = motor_asyncio.AsyncIOMotorClient(settings.MONGO_URL)
+        _async_clients[key] = client
+    return client
+
+# Clients by (pid, loop). A client holds a reference to its loop, so
+# entries are removed by _discard_stale_clients() rather than weakly
+_async_clients = {}
+
+def _discard_stale_clients():
+    pid = os.getpid()
+    for key in list(_async_clients):
+        key_pid, loop = key
+        if key_pid != pid:
+            # Inherited through fork, the sockets belong to the parent
+            _async_clients.pop(key, None)
+        elif loop.is_closed():
+            client = _async_clients.pop(key, None)
+            if client is not None:
+                client.close()
+
+@lru_cache(maxsize=None)
+def _sync_client(url):
+    # One pymongo client serves all channels
+    return pymongo.MongoClient(url)
+
+
 def _adapt(instance):
     adapted = {}
     for key, value in instance.items():
@@ -1,16 +1,45 @@
-import json
+import asyncio
+import os
 import redis
+from functools import lru_cache
 from asgiref.sync import async_to_sync
 from django.utils.functional import cached_property
 from django.conf import settings
-from rxdjango.serialize import json_dumps
+from rxdjango.serialize import json_dumps, json_loads
 
 
 async def _connect():
-    return await redis.asyncio.from_url(settings.REDIS_URL)
+    # Async clients are bound to the loop they run in, so there is one
+    # per loop, shared by all sessions instead of a pool per connection
+    key = (os.getpid(), asyncio.get_running_loop())
+    conn = _async_clients.get(key)
+    if conn is None:
+        _discard_stale_clients()
+        conn = redis.asyncio.from_url(settings.REDIS_URL)
+        _async_clients[key] = conn
+    return conn
+
+# Clients by (pid, loop). A client holds a reference to its loop, so
+# entries are removed by _discard_stale_clients() rather than weakly
+_async_clients = {}
+
+def _discard_stale_clients():
+    # Connections of a closed loop or of the parent process can't be
+    # closed from here, they are dropped along with the client
+    pid = os.getpid()
+    for key in list(_async_clients):
+        key_pid, loop = key
+        if key_pid != pid or loop.is_closed():
+            _async_clients.pop(key, None)
 
 def _sync_connect():
-    return redis.from_url(settings.REDIS_URL)
+    return _sync_client(settings.REDIS_URL)
+
+@lru_cache(maxsize=None)
+def _sync_client(url):
+    # Clients are thread safe and keep a connection pool, so signal
+    # handlers reuse connections instead of opening one per call
+    return redis.from_url(url)
 
 
 async def get_tstamp():
@@ -265,9 +294,10 @@ class RedisStateSession(RedisSession):
         serialized_instances = [json_dumps(instance) for instance in instances]
 
         script = """
-        -- Append the serialized instances to instances list
-        for i, obj in ipairs(ARGV) do
-            redis.call("RPUSH", KEYS[3], obj)
+        -- Append the serialized instances to instances list, with one
+        -- RPUSH per thousand instances, below Lua's unpack() limit
+        for i = 1, #ARGV, 1000 do
+            redis.call("RPUSH", KEYS[3], unpack(ARGV, i, math.min(i + 999, #ARGV)))
         end
 
         local instances_size = redis.call("LLEN", KEYS[3]) -- Get the updated size of instances
@@ -329,7 +359,7 @@ class RedisStateSession(RedisSession):
 
                 cursor = instances_length
 
-                yield [json.loads(serialized) for serialized in new_instances]
+                yield [json_loads(serialized) for serialized in new_instances]
 
             if last_length < 0:
                 await self._conn.unsubscribe(self.instances_trigger)
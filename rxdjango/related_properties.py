@@ -1,3 +1,4 @@
+from functools import lru_cache
 from .exceptions import UnknownProperty
 
 
@@ -69,6 +70,7 @@ class RelatedProperty:
         cls.unknown_properties.add(key)
         return cls.accessors.get(key)
 
+@lru_cache(maxsize=None)
 def _make_key(model, property_name):
     qualname = '.'.join([model.__name__, property_name])
     return (model.__module__, qualname)
@@ -1,8 +1,13 @@
-import json
+import orjson
 from pytz import utc
 from datetime import datetime
 
 
+# Datetimes go through default_serializer to keep the wire format,
+# and non-str keys are converted as the json module does
+_DUMPS_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
 def default_serializer(value):
     if isinstance(value, datetime):
         value = utc.normalize(value)
@@ -11,5 +16,18 @@ def default_serializer(value):
     return str(value)
 
 
-def json_dumps(value):    
-    return json.dumps(value, default=default_serializer)
+def json_dumpb(value):
+    """Same as json_dumps, returning UTF-8 encoded bytes"""
+    return orjson.dumps(
+        value,
+        default=default_serializer,
+        option=_DUMPS_OPTIONS,
+    )
+
+
+def json_dumps(value):
+    return json_dumpb(value).decode()
+
+
+def json_loads(value):
+    return orjson.loads(value)
@@ -1,4 +1,7 @@
+import weakref
 from collections import defaultdict
+from functools import partial
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models.signals import (pre_save, post_save,
                                       pre_delete, post_delete,
                                       post_migrate)
@@ -40,6 +43,30 @@ class SignalHandler:
             self._connect_layer(model_layer)
 
     def _connect_layer(self, layer):
+        # Path from an instance in this layer to its parent
+        if layer.reverse_acessor:
+            reverse_parts = layer.reverse_acessor.split('.')
+        else:
+            reverse_parts = None
+
+        # Key of this layer in the per instance dicts below
+        reparent_key = (self.name, *layer.instance_path)
+
+        # If the reverse accessor is a plain foreign key, the parent id
+        # last committed by a save is kept in instance._rx_parents so that
+        # prepare_save can tell whether the parent changed without
+        # querying the database
+        fk_field = _get_fk_field(layer.model, layer.reverse_acessor)
+        fk_attname = fk_field.attname if fk_field else None
+
+        def remember_parent(sender, instance, **kwargs):
+            parents = instance.__dict__.setdefault('_rx_parents', {})
+            if transaction.get_autocommit(kwargs.get('using')):
+                parents[reparent_key] = instance.__dict__.get(fk_attname, _UNKNOWN)
+            else:
+                # Not committed yet, a rollback would leave the
+                # previous parent in the database
+                parents.pop(reparent_key, None)
 
         def relay_instance_optimistically(sender, instance, **kwargs):
             if sender is layer.model:
@@ -54,18 +81,45 @@ class SignalHandler:
                 serialized = layer.serialize_instance(instance, tstamp)
                 serialized['_operation'] = 'update'
                 serialized['_optimistic'] = True
-                self._schedule(serialized, layer)
+                self._schedule([(serialized, None)])
 
         def prepare_save(sender, instance, **kwargs):
             # Check if this instance has changed parent
             # If so we need to relay the old and new parent
             if not layer.reverse_acessor:
                 return
-            if kwargs.get('created', False):
-                instance.__parent_updated = True
+            reparented = instance.__dict__.setdefault('_rx_reparented', {})
+            reparented.pop(reparent_key, None)
+            if instance._state.adding:
+                # A new instance has no previous parent
+                return
+            if fk_attname:
+                saved = instance.__dict__.get('_rx_parents', {}).get(reparent_key, _UNKNOWN)
+                if saved is not _UNKNOWN and \
+                   saved == instance.__dict__.get(fk_attname, _UNKNOWN):
+                    return
+                # Fetch only the parent id column, and the old parent
+                # itself only if it has actually changed
+                old_ids = sender._base_manager.filter(
+                    pk=instance.pk or instance.id,
+                ).values_list(fk_attname, flat=True)[:1]
+                if not old_ids:
+                    return # Should not happen, but who knows
+                old_id = old_ids[0]
+                if old_id == getattr(instance, fk_attname):
+                    return
+                old_parent = None
+                if old_id is not None:
+                    # The foreign key holds the value of its target field,
+                    # which is not necessarily the parent's pk
+                    Parent = fk_field.related_model
+                    old_parent = Parent._base_manager.filter(**{
+                        fk_field.target_field.attname: old_id,
+                    }).first()
+                reparented[reparent_key] = old_parent
                 return
             try:
-                current = sender.objects.get(pk=instance.pk or instance.id)
+                current = sender._base_manager.get(pk=instance.pk or instance.id)
             except sender.DoesNotExist:
                 return # Should not happen, but who knows
             acessor = layer.reverse_acessor
@@ -77,86 +131,124 @@ class SignalHandler:
                 return
             new_parent = getattr(instance, acessor)
             if new_parent != old_parent:
-                instance.__parent_updated = True
-                instance.__old_parent = old_parent
+                reparented[reparent_key] = old_parent
 
-        def _relay_instance(_layer, instance, tstamp, operation, already_relayed=None):
+        def _relay_instance(_layer, instance, tstamp, operation, batch, already_relayed=None):
+            """Relay a model instance or all instances of a related manager"""
             if not instance:
                 return
             if already_relayed is None:
                 already_relayed = set()
-            if isinstance(instance, models.Model):
+            if isinstance(instance, models.Manager):
+                # Stream related rows instead of filling the queryset cache,
+                # prefetching many related fields for each chunk
+                instances = instance.all().prefetch_related(
+                    *_layer.many_prefetch
+                ).iterator(chunk_size=1000)
+            elif isinstance(instance, models.Model):
                 instances = [instance]
-            elif isinstance(instance, models.Manager):
-                instances = instance.all()
             else:
                 raise ProgrammingError()
 
+            _relay_instances(_layer, instances, tstamp, operation, batch, already_relayed)
+
+        def _relay_instances(_layer, instances, tstamp, operation, batch, already_relayed):
+            instance_type = _layer.instance_type
+            relayed = []
             for _instance in instances:
+                # Skip duplicates before paying for serialization
+                key = (instance_type, _instance.id)
+                if key in already_relayed:
+                    continue
+                already_relayed.add(key)
+
                 if operation == 'delete':
                     serialized = _layer.serialize_delete(_instance, tstamp)
                 else:
                     serialized = _layer.serialize_instance(_instance, tstamp)
                 serialized['_operation'] = operation
-                key = f'{_layer.instance_type}:{_instance.id}'
-                if key in already_relayed:
-                    continue
-                already_relayed.add(key)
-
-
-                self._schedule(serialized, _layer)
-
-                if operation == 'create':
-                    # If instance is being created in this channel,
-                    # then all related objects need to be scheduled
-                    for attribute, child_layer in _layer.children.items():
-                        child = getattr(_instance, attribute, None)
-                        if child is None:
-                            continue
-                        elif isinstance(child, models.QuerySet):
-                            children = child.all()
-                        else:
-                            children = [child]
-
-                        for child in children:
-                            try:
-                                if child.id is None:
-                                    continue
-                            except AttributeError:
-                                pass
-                            _relay_instance(child_layer, child, tstamp, operation, already_relayed)
+                batch.append((serialized, None))
+                relayed.append(_instance)
+
+            if operation == 'create' and relayed:
+                # If instance is being created in this channel,
+                # then all related objects need to be scheduled.
+                # Each child layer is fetched for all instances at once.
+                # These may be the caller's own objects, so prefetch caches
+                # added here are removed once the children are relayed
+                kept = _prefetched_keys(relayed)
+                for child_layer in _layer.children.values():
+                    children = [
+                        child for child in child_layer.gather(relayed)
+                        # Unsaved related objects have no id yet
+                        if getattr(child, 'id', 0) is not None
+                    ]
+                    children_kept = _prefetched_keys(children)
+                    child_layer.prefetch_many(children)
+                    _relay_instances(child_layer, children, tstamp, operation, batch, already_relayed)
+                    _clear_prefetched(children, children_kept)
+                _clear_prefetched(relayed, kept)
 
         def relay_instance(sender, instance, **kwargs):
             if sender is layer.model:
-                tstamp = sync_get_tstamp()
+                # broadcast_instance() fans out to several layers and
+                # passes one tstamp for the whole batch
+                tstamp = kwargs.get('_tstamp') or sync_get_tstamp()
                 created = kwargs.get('created', None)
                 operation = kwargs.get('_operation', 'update' if not created else 'create')
                 if operation == 'create':
                     created = True
-                _relay_instance(layer, instance, tstamp, operation)
-                if not layer.origin or not layer.reverse_acessor:
-                    return
-                if created or getattr(instance, '__parent_updated', False):
+                # Everything relayed by this signal is scheduled together
+                batch = []
+                # Signals always carry a model instance
+                _relay_instances(layer, [instance], tstamp, operation, batch, set())
+                reparented = instance.__dict__.get('_rx_reparented', {})
+                reparent = reparent_key in reparented
+                old_pa = reparented.pop(reparent_key, None)
+                if layer.origin and reverse_parts and (created or reparent):
                     parent = instance
-                    for reverse_acessor in layer.reverse_acessor.split('.'):
+                    for reverse_acessor in reverse_parts:
                         parent = getattr(parent, reverse_acessor, None)
-                    _relay_instance(layer.origin, parent, tstamp, 'update')
-                    old_pa = getattr(instance, '__old_parent', None)
-                    _relay_instance(layer.origin, old_pa, tstamp, 'update')
+                    _relay_instance(layer.origin, parent, tstamp, 'update', batch)
+                    _relay_instance(layer.origin, old_pa, tstamp, 'update', batch)
+                self._schedule(batch)
 
         def prepare_deletion(sender, instance, **kwargs):
-            """Obtain anchors prior to deletion and store in instance"""
+            """Obtain anchors prior to deletion and keep them by the
+            object the delete was called on.
+            Layers with the same instance type reach the same anchors,
+            so this is connected once per instance type in this channel"""
             if sender is layer.model:
-                tstamp = sync_get_tstamp()
+                origin = kwargs.get('origin') or instance
+                key = (self.name, layer.instance_type, instance.pk)
+                pending = _deletions.get(origin)
+                if pending is None or key in pending[1]:
+                    # Finding this instance already there means a previous
+                    # delete of the same origin raised after pre_delete
+                    pending = _deletions[origin] = (sync_get_tstamp(), {})
+                # All instances deleted in one cascade share a tstamp
+                tstamp, deletions = pending
                 serialized = layer.serialize_delete(instance, tstamp)
-                anchors = layer.get_anchors(serialized)
-                instance._anchors = list(anchors)
-                instance._serialized = serialized
+                anchor_ids = list(layer.get_anchor_ids(serialized))
+                deletions[key] = (serialized, anchor_ids)
 
         def relay_delete_instance(sender, instance, **kwargs):
             if sender is layer.model:
-                serialized = instance._serialized
-                self._schedule(serialized, layer, instance._anchors)
+                origin = kwargs.get('origin') or instance
+                pending = _deletions.get(origin)
+                if pending is None:
+                    return
+                deletions = pending[1]
+                key = (self.name, layer.instance_type, instance.pk)
+                try:
+                    serialized, anchor_ids = deletions.pop(key)
+                except KeyError:
+                    return
+                # post_delete only comes after all pre_delete signals of
+                # the cascade, so the shared tstamp is no longer needed
+                if not deletions:
+                    del _deletions[origin]
+                self._schedule([(serialized, anchor_ids)])
 
         uid = '-'.join(['cache', self.name] + layer.instance_path)
 
@@ -168,6 +260,14 @@ class SignalHandler:
                 weak=False,
             )
 
+        if fk_attname:
+            post_save.connect(
+                remember_parent,
+                sender=layer.model,
+                dispatch_uid=f'{uid}-remember-parent',
+                weak=False,
+            )
+
         pre_save.connect(
             prepare_save,
             sender=layer.model,
@@ -182,51 +282,109 @@ class SignalHandler:
             weak=False,
         )
 
+        # Deletions are handled by the first layer of each instance type
+        delete_uid = f'cache-{self.name}-{layer.instance_type}'
+
         pre_delete.connect(
             prepare_deletion,
             sender=layer.model,
-            dispatch_uid=f'{uid}-prepare-deletion',
+            dispatch_uid=f'{delete_uid}-prepare-deletion',
             weak=False,
         )
 
         post_delete.connect(
             relay_delete_instance,
             sender=layer.model,
-            dispatch_uid=f'{uid}-delete',
+            dispatch_uid=f'{delete_uid}-delete',
             weak=False,
         )
 
         self.relay_map[layer.model].append(relay_instance)
 
-    def _schedule(self, serialized, state_model, anchors=None):
-        if serialized['id'] is None and serialized['_operation'] == 'create':
-            raise RxDjangoBug('Saving instance without id causes data leakage. '
-                              'Check stack trace to fix this bug.')
+    def _schedule(self, batch):
+        """Relay a list of (serialized, anchor_ids) after commit.
+        anchor_ids may be None, in which case they're queried at relay time"""
+        if not batch:
+            return
+        for serialized, anchor_ids in batch:
+            if serialized['id'] is None and serialized['_operation'] == 'create':
+                raise RxDjangoBug('Saving instance without id causes data leakage. '
+                                  'Check stack trace to fix this bug.')
         if transaction.get_autocommit():
-            self._relay(serialized, state_model, anchors)
+            self._relay(batch)
             return
 
-        transaction.on_commit(
-            lambda: self._relay(serialized, state_model, anchors)
-        )
-
-    def _relay(self, serialized, state_model, anchors):
-        """Send one update for both cache and connected clients"""
-        user_id = serialized.get('_user_key', None)
-        payload = [serialized]
-        #print(f'Relay from {serialized["_instance_type"]}')
-        if anchors is None:
-            anchors = state_model.get_anchors(serialized)
-        for anchor in anchors:
-            #print(f'... to {anchor.__class__.__name__} {anchor}')
-            deltas = self.mongo.write_instances(anchor.id, payload)
+        transaction.on_commit(partial(self._relay, batch))
+
+    def _relay(self, batch):
+        """Send updates for both cache and connected clients, grouped so that
+        each anchor and user receives a single payload"""
+        # Query anchors for the whole batch at once
+        unresolved = [serialized for serialized, anchor_ids in batch
+                      if anchor_ids is None]
+        resolved = iter(self.state_model.get_anchors_bulk(unresolved))
+
+        payloads = defaultdict(list)
+        for serialized, anchor_ids in batch:
+            user_id = serialized.get('_user_key', None)
+            #print(f'Relay from {serialized["_instance_type"]}')
+            if anchor_ids is None:
+                anchor_ids = next(resolved)
+            for anchor_id in anchor_ids:
+                payloads[(anchor_id, user_id)].append(serialized)
+
+        dispatches = []
+        for (anchor_id, user_id), payload in payloads.items():
+            deltas = self.mongo.write_instances(anchor_id, payload)
             if deltas:
-                self.wsrouter.sync_dispatch(deltas, anchor.id, user_id)
+                dispatches.append((deltas, anchor_id, user_id))
+        self.wsrouter.sync_dispatch_many(dispatches)
 
     def broadcast_instance(self, anchor_id, instance, operation='update'):
         kwargs = {
-            '_operation': operation
+            '_operation': operation,
+            '_tstamp': sync_get_tstamp(),
         }
         sender = instance.__class__
-        for relay_instance in self.relay_map[sender]:
+        # relay_map is a defaultdict, avoid inserting unrelated models
+        for relay_instance in self.relay_map.get(sender, ()):
             relay_instance(sender, instance, **kwargs)
+
+
+# Marks a parent id that is not known, e.g. deferred field
+_UNKNOWN = object()
+
+# Deletions prepared in pre_delete and waiting for post_delete, by the
+# origin of the delete, as (tstamp, {(channel, instance_type, pk): ...})
+_deletions = weakref.WeakKeyDictionary()
+
+
+def _prefetched_keys(instances):
+    """Names of the relations already prefetched on each instance"""
+    return [
+        set(instance.__dict__.get('_prefetched_objects_cache', ()))
+        for instance in instances
+    ]
+
+
+def _clear_prefetched(instances, kept):
+    """Drop prefetch caches added since _prefetched_keys() was called,
+    so that later queries in user code are not served stale results"""
+    for instance, keys in zip(instances, kept):
+        cache = instance.__dict__.get('_prefetched_objects_cache')
+        if cache:
+            for key in cache.keys() - keys:
+                del cache[key]
+
+
+def _get_fk_field(model, accessor):
+    """Return the field if accessor is a concrete foreign key on model"""
+    if not accessor or '.' in accessor:
+        return None
+    try:
+        field = model._meta.get_field(accessor)
+    except FieldDoesNotExist:
+        return None
+    if not field.many_to_one or not field.concrete:
+        return None
+    return field
@@ -60,6 +60,12 @@ class StateLoader:
         """Filter out other user's instances.
         During COLD, HEATING and COOLING loader has to deal with all users
         """
+        if not self.state_model.user_scoped:
+            # All _user_key are None, nothing to filter, but the key
+            # is still dropped so the payload is the same either way
+            for instance in instances:
+                instance.pop('_user_key', None)
+            return instances
         return [
             i for i in instances if i.pop('_user_key') in (self.user_id, None)
         ]
@@ -118,7 +124,7 @@ class StateLoader:
         """
         async for instances in self.redis.list_instances():
             await self.mongo.write_instances(instances)
-            instances = self._filter(instances)
+            instances = self._user_filter(instances)
             yield mark(instances, 'cooling')
 
     router = [
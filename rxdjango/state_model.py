@@ -1,6 +1,9 @@
+import sys
 from collections import defaultdict
+from operator import attrgetter
 from rest_framework import serializers
 from django.db import models, connection
+from django.db.models import prefetch_related_objects
 from django.db import ProgrammingError
 from django.db.models.fields import related_descriptors
 from .ts import export_interface
@@ -9,6 +12,15 @@ from .related_properties import is_related_property, get_accessor, get_reverse_a
 
 class StateModel:
 
+    __slots__ = (
+        'nested_serializer', 'many', 'origin', 'reverse_acessor', 'anchor',
+        'instance_path', 'query_path', 'index', 'accessor', 'model',
+        'anchor_key', 'instance_type', 'user_key', 'optimistic',
+        'optimistic_timeout', 'flat_serializer', 'children', 'user_scoped',
+        '_flat', '_mark', '_mark_template', '_delete_template', '_plan',
+        '_prefetch', 'many_prefetch',
+    )
+
     def __init__(self, state_serializer, many=False, origin=None, instance_property=None, query_property=None, reverse_acessor=None):
         self.nested_serializer = state_serializer
         self.many = many
@@ -18,26 +30,41 @@ class StateModel:
         if origin is None:
             self.anchor = self
             self.instance_path = []
-            self.query_path = []
+            # Lookup from the anchor model to this node, built incrementally
+            self.query_path = ''
             self.index = defaultdict(list)
         else:
             self.anchor = origin.anchor
-            self.instance_path = origin.instance_path[:] + [instance_property]
-            self.query_path = origin.query_path[:] + [query_property]
+            self.instance_path = origin.instance_path + [instance_property]
+            if origin.query_path:
+                self.query_path = f'{origin.query_path}__{query_property}'
+            else:
+                self.query_path = query_property
             self.index = origin.index
 
+        # Gets the related object or manager from an instance of origin
+        self.accessor = attrgetter(instance_property) if origin else None
+
+        # Relations, unlike properties, can be prefetched for all
+        # origin instances at once
+        self._prefetch = None
+        if origin and not isinstance(
+            getattr(origin.model, instance_property, None), property
+        ):
+            self._prefetch = instance_property
+
         meta = state_serializer.Meta
         self.model = meta.model
 
         if origin:
-            self.anchor_key = '__'.join(self.query_path)
+            self.anchor_key = self.query_path
         else:
             self.anchor_key = self.model._meta.pk.name
 
-        self.instance_type = '.'.join([
+        self.instance_type = sys.intern('.'.join([
             self.nested_serializer.__module__,
             self.nested_serializer.__class__.__name__,
-        ])
+        ]))
         #modu = self.nested_serializer.__module__.replace('.serializers', '')
         #print(f"""perl -pi -e "s/instance_type === '{modu}.{self.model.__name__}/instance_type === '{self.instance_type}/" $1""")
 
@@ -49,7 +76,24 @@ class StateModel:
         self.optimistic = getattr(meta, 'optimistic', False)
         self.optimistic_timeout = getattr(meta, 'optimistic_timeout', 3)
 
+        # Markers added to every serialized instance by _mark()
+        self._mark_template = {
+            '_instance_type': self.instance_type,
+            '_tstamp': None,
+            '_operation': 'initial_state',
+            '_user_key': None,
+        }
+        self._delete_template = {
+            **self._mark_template,
+            '_operation': 'delete',
+            '_deleted': True,
+        }
+        self._mark = self._build_mark()
+
         self.flat_serializer, fields = self._disassemble_nested()
+        # DRF builds serializer fields on every instantiation, so a single
+        # instance is kept and its to_representation() called for each row
+        self._flat = self.flat_serializer()
 
         self.children = {}
         for field_name, serializer in fields.items():
@@ -57,7 +101,36 @@ class StateModel:
             if node:
                 self.children[field_name] = node
 
-        export_interface(self.nested_serializer.__class__)
+        # Many related children are serialized by the flat serializer as
+        # lists of ids, these are prefetched before serializing instances.
+        # Meta.prefetch_related may add lookups used by other fields,
+        # such as a SerializerMethodField reading a related object.
+        self.many_prefetch = tuple(
+            child._prefetch for child in self.children.values()
+            if child.many and child._prefetch
+        ) + _check_prefetch_related(state_serializer, self.model)
+
+        # The subtree flattened in depth-first order, as (node, parent)
+        # pairs where parent is the position of the origin node in the plan
+        plan = [(self, None)]
+        for child in self.children.values():
+            offset = len(plan)
+            for node, parent in child._plan:
+                plan.append((node, offset + parent if parent is not None else 0))
+        self._plan = tuple(plan)
+
+        if origin is None:
+            # The tree is complete, freeze the index shared by all nodes
+            index = {key: tuple(nodes) for key, nodes in self.index.items()}
+            for model in self.models():
+                model.index = index
+
+            # Whether any instance in this state belongs to a single user
+            self.user_scoped = any(model.user_key for model in self.models())
+
+            # Nodes of the same instance type share a serializer class
+            for nodes in index.values():
+                export_interface(nodes[0].nested_serializer.__class__)
 
     def __str__(self):
         return f'StateModel for {self.instance_type}'
@@ -70,76 +143,145 @@ class StateModel:
 
     def models(self):
         for models in self.index.values():
-            for model in models:
-                yield model
+            yield from models
 
     def frontend_model(self):
         frontend = {}
         for key, nodes in self.index.items():
             node = nodes[0]
-            instance_model = {}
-            frontend[key] = instance_model
-            serializer = node.nested_serializer
-            for field_name, field in serializer._declared_fields.items():
-                if is_model_serializer(field):
-                    instance_model[field_name] = node[field_name].instance_type
+            # Nested serializer fields were classified when building children
+            frontend[key] = {
+                field_name: child.instance_type
+                for field_name, child in node.children.items()
+            }
 
         return frontend
 
-    def get_anchors(self, serialized):
-        """Get all anchors that should receive an instance"""
+    def get_anchor_ids(self, serialized):
+        """Get ids of all anchors that should receive an instance"""
         peer_type = serialized['_instance_type']
-        peer_models = self.index[peer_type]
+        peer_models = self.index.get(peer_type, ())
         for peer_model in peer_models:
             anchor_key = peer_model.anchor_key
             kwargs = {anchor_key: serialized['id']}
-            for instance in self.anchor.model.objects.filter(**kwargs):
-                yield instance
+            yield from self.anchor.model.objects.filter(
+                **kwargs
+            ).values_list('pk', flat=True)
+
+    def get_anchors_bulk(self, serialized_list):
+        """Get the ids of all anchors that should receive each instance.
+        Returns a list of anchor id lists, in the same order as serialized_list.
+        Makes one query per instance type and anchor key, instead of one
+        per instance"""
+        ids_by_type = defaultdict(set)
+        for serialized in serialized_list:
+            ids_by_type[serialized['_instance_type']].add(serialized['id'])
+
+        # (instance_type, id) -> anchor ids, as dict keys to keep order.
+        # Ids are compared as strings, as serializers render some primary
+        # keys, like UUIDs, differently from what the database returns
+        anchors = defaultdict(dict)
+        Anchor = self.anchor.model
+        for peer_type, ids in ids_by_type.items():
+            for peer_model in self.index.get(peer_type, ()):
+                anchor_key = peer_model.anchor_key
+                rows = Anchor.objects.filter(
+                    **{f'{anchor_key}__in': ids}
+                ).values_list('pk', anchor_key)
+                for anchor_id, peer_id in rows:
+                    anchors[(peer_type, str(peer_id))][anchor_id] = None
+
+        return [
+            list(anchors.get(
+                (serialized['_instance_type'], str(serialized['id'])), ()
+            ))
+            for serialized in serialized_list
+        ]
 
     def serialize_instance(self, instance, tstamp):
-        data = self.flat_serializer(instance).data
+        data = self._flat.to_representation(instance)
         return self._mark(data, tstamp)
 
     def serialize_delete(self, instance, tstamp):
         pk = instance.pk or instance.id
-        data = self._mark({'id': pk}, tstamp)
-        data['_deleted'] = True
-        data['_operation'] = 'delete'
+        data = {'id': pk, **self._delete_template}
+        data['_tstamp'] = tstamp
+        if self.user_key:
+            data['_user_key'] = data.get(self.user_key, None)
         return data
 
     def serialize_state(self, instance, tstamp):
+        """Yield lists of serialized instances, one list per node
+        of the state model"""
         if self.many:
-            data = self.flat_serializer(instance.all(), many=True).data
-            instances = instance.all()
+            instances = list(instance.all())
         else:
-            data = [ self.flat_serializer(instance).data ]
             instances = [instance]
 
-        for serialized in data:
-            self._mark(serialized, tstamp)
-
-        yield data
-
-        for field_name, peer_model in self.children.items():
-            for instance in instances:
-                try:
-                    peer_instance = getattr(instance, field_name)
-                except AttributeError:
-                    continue
-                if peer_instance is None:
-                    continue
-                for serialized in peer_model.serialize_state(peer_instance, tstamp):
-                    yield serialized
-
-    def _mark(self, serialized, tstamp):
-        serialized['_instance_type'] = self.instance_type
-        serialized['_tstamp'] = tstamp
-        serialized['_operation'] = 'initial_state'
-        if self.user_key:
-            serialized['_user_key'] = serialized.get(self.user_key, None)
+        yield from self._serialize_instances(instances, tstamp)
+
+    def _serialize_instances(self, instances, tstamp):
+        """Run the serialization plan of this subtree iteratively"""
+        gathered = []
+        for node, parent in self._plan:
+            if parent is not None:
+                instances = node.gather(gathered[parent])
+            gathered.append(instances)
+            if instances:
+                node.prefetch_many(instances)
+                to_representation = node._flat.to_representation
+                yield [
+                    node._mark(to_representation(instance), tstamp)
+                    for instance in instances
+                ]
+
+    def prefetch_many(self, instances):
+        """Prefetch, for all instances at once, the many related fields
+        and Meta.prefetch_related lookups that would otherwise be
+        queried for each serialized instance"""
+        if self.many_prefetch:
+            prefetch_related_objects(instances, *self.many_prefetch)
+
+    def gather(self, origin_instances):
+        """Get the instances of this node related to all origin instances.
+        A peer shared by several instances is serialized only once."""
+        accessor = self.accessor
+        if self._prefetch:
+            # One query for this node, instead of one per origin instance
+            prefetch_related_objects(origin_instances, self._prefetch)
+        peers = {}
+        for instance in origin_instances:
+            try:
+                peer_instance = accessor(instance)
+            except AttributeError:
+                continue
+            if peer_instance is None:
+                continue
+            if self.many:
+                peers.update(dict.fromkeys(peer_instance.all()))
+            else:
+                peers[peer_instance] = None
+        return list(peers)
+
+    def _build_mark(self):
+        """Build the function that adds markers to a serialized instance,
+        specialized on whether this node declares a user_key"""
+        template = self._mark_template
+        user_key = self.user_key
+
+        if user_key:
+            def mark(serialized, tstamp):
+                serialized.update(template)
+                serialized['_tstamp'] = tstamp
+                serialized['_user_key'] = serialized.get(user_key, None)
+                return serialized
         else:
-            serialized['_user_key'] = None
-        return serialized
+            def mark(serialized, tstamp):
+                serialized.update(template)
+                serialized['_tstamp'] = tstamp
+                return serialized
+
+        return mark
 
     def _disassemble_nested(self):
         serializer_fields = {}
@@ -152,14 +294,9 @@ class StateModel:
                 continue
 
             if is_related_property(self.model, field_name):
-                try:
-                    new_field = serializers.PrimaryKeyRelatedField(
-                        many=field.many, read_only=True,
-                    )
-                except AttributeError:
-                    new_field = serializers.PrimaryKeyRelatedField(
-                        read_only=True,
-                    )
+                new_field = serializers.PrimaryKeyRelatedField(
+                    many=getattr(field, 'many', False), read_only=True,
+                )
                 serializer_fields[field_name] = field
                 declared_fields[field_name] = new_field
             elif is_model_serializer(field):
@@ -180,78 +317,133 @@ class StateModel:
         return FlatSerializer, serializer_fields
 
     def _build_child(self, field_name, serializer):
-        try:
-            descriptor = getattr(self.model, field_name)
-        except AttributeError:
+        descriptor = getattr(self.model, field_name, None)
+        if descriptor is None:
             return
 
-        if isinstance(descriptor, related_descriptors.ManyToManyDescriptor):
-            related_descriptor = getattr(descriptor.field.model, descriptor.field.name)
-            return StateModel(
-                serializer.child,
-                True,
-                self,
-                field_name,
-                field_name,
-                descriptor.field.name,
-            )
-
-        if isinstance(descriptor, related_descriptors.ReverseManyToOneDescriptor):
-            related_descriptor = getattr(descriptor.field.model, descriptor.field.name)
-            return StateModel(
-                serializer.child,
-                True,
-                self,
-                field_name,
-                related_descriptor.field.related_query_name(),
-                descriptor.field.name,
-            )
-
-        if isinstance(descriptor, related_descriptors.ForwardManyToOneDescriptor):
-            return StateModel(
-                serializer,
-                False,
-                self,
-                field_name,
-                field_name,
-                descriptor.field.related_query_name(),
-            )
-
-        if isinstance(descriptor, related_descriptors.ReverseOneToOneDescriptor):
-            return StateModel(
-                serializer,
-                False,
-                self,
-                field_name,
-                field_name,
-                descriptor.related.remote_field.name,
-            )
-
-        if isinstance(descriptor, property):
-            query_property = get_accessor(self.model, field_name)
-            reverse_acessor = get_reverse_accessor(self.model, field_name)
-            if not query_property:
-                my_module = self.__class__.__module__
-                raise UnknownProperty(
-                    f'Unknown property {field_name} in '
-                    f'{self.model.__module__}.{self.model.__name__}.\n'
-                    f'Use {my_module}.decorators.related_property '
-                    'to provide an acessor'
-                )
+        # Walk the MRO so that descriptor subclasses (e.g. forward one to
+        # one) are built as their base, and many to many wins over
+        # reverse many to one, which it inherits from
+        for klass in type(descriptor).__mro__:
+            build = _CHILD_BUILDERS.get(klass)
+            if build:
+                return build(self, field_name, serializer, descriptor)
+
+
+def _build_many_to_many(origin, field_name, serializer, descriptor):
+    return StateModel(
+        serializer.child,
+        True,
+        origin,
+        field_name,
+        field_name,
+        descriptor.field.name,
+    )
+
+
+def _build_reverse_many_to_one(origin, field_name, serializer, descriptor):
+    related_descriptor = getattr(descriptor.field.model, descriptor.field.name)
+    return StateModel(
+        serializer.child,
+        True,
+        origin,
+        field_name,
+        related_descriptor.field.related_query_name(),
+        descriptor.field.name,
+    )
+
+
+def _build_forward_many_to_one(origin, field_name, serializer, descriptor):
+    return StateModel(
+        serializer,
+        False,
+        origin,
+        field_name,
+        field_name,
+        descriptor.field.related_query_name(),
+    )
+
+
+def _build_reverse_one_to_one(origin, field_name, serializer, descriptor):
+    return StateModel(
+        serializer,
+        False,
+        origin,
+        field_name,
+        field_name,
+        descriptor.related.remote_field.name,
+    )
+
+
+def _build_property(origin, field_name, serializer, descriptor):
+    model = origin.model
+    query_property = get_accessor(model, field_name)
+    reverse_acessor = get_reverse_accessor(model, field_name)
+    if not query_property:
+        my_module = StateModel.__module__
+        raise UnknownProperty(
+            f'Unknown property {field_name} in '
+            f'{model.__module__}.{model.__name__}.\n'
+            f'Use {my_module}.decorators.related_property '
+            'to provide an acessor'
+        )
 
-            many = getattr(serializer, 'many', False)
-            return StateModel(
-                serializer.child if many else serializer,
-                many,
-                self,
-                field_name,
-                query_property,
-                reverse_acessor,
-            )
+    many = getattr(serializer, 'many', False)
+    return StateModel(
+        serializer.child if many else serializer,
+        many,
+        origin,
+        field_name,
+        query_property,
+        reverse_acessor,
+    )
+
+
+_CHILD_BUILDERS = {
+    related_descriptors.ManyToManyDescriptor: _build_many_to_many,
+    related_descriptors.ReverseManyToOneDescriptor: _build_reverse_many_to_one,
+    related_descriptors.ForwardManyToOneDescriptor: _build_forward_many_to_one,
+    related_descriptors.ReverseOneToOneDescriptor: _build_reverse_one_to_one,
+    property: _build_property,
+}
+
+
+def _check_prefetch_related(state_serializer, model):
+    """Validate Meta.prefetch_related, so that a wrong lookup fails
+    when the StateModel is built instead of inside a signal handler"""
+    lookups = getattr(state_serializer.Meta, 'prefetch_related', ())
+    name = f'{state_serializer.__class__.__name__}.Meta.prefetch_related'
+    if not isinstance(lookups, (list, tuple)):
+        raise ProgrammingError(f'{name} must be a list or tuple of lookups')
+    for lookup in lookups:
+        path = getattr(lookup, 'prefetch_through', lookup)
+        if not isinstance(path, str):
+            raise ProgrammingError(f'{name} has invalid lookup {lookup!r}')
+        current = model
+        for part in path.split('__'):
+            if not hasattr(current, part):
+                raise ProgrammingError(f'{name} declares "{path}", but {current.__name__} has no attribute "{part}"')
+            current = _related_model(getattr(current, part))
+            if current is None:
+                # Not a relation descriptor (e.g. a GenericForeignKey),
+                # the rest of the path is left for Django to resolve
+                break
+    return tuple(lookups)
+
+
+def _related_model(descriptor):
+    if isinstance(descriptor, related_descriptors.ManyToManyDescriptor):
+        rel = descriptor.rel
+        return rel.related_model if descriptor.reverse else rel.model
+    if isinstance(descriptor, related_descriptors.ReverseManyToOneDescriptor):
+        return descriptor.rel.related_model
+    if isinstance(descriptor, related_descriptors.ForwardManyToOneDescriptor):
+        return descriptor.field.related_model
+    if isinstance(descriptor, related_descriptors.ReverseOneToOneDescriptor):
+        return descriptor.related.related_model
+    return None
 
 
 def is_model_serializer(field):
-    try:
-        return isinstance(field.child, serializers.ModelSerializer)
-    except AttributeError:
-        return isinstance(field, serializers.ModelSerializer)
+    field = getattr(field, 'child', field)
+    return isinstance(field, serializers.ModelSerializer)
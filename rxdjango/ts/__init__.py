@@ -1,5 +1,7 @@
 import os
 import difflib
+import hashlib
+from functools import lru_cache
 import subprocess
 from django.utils import timezone
 from rest_framework import serializers
@@ -23,15 +25,38 @@ def ts_exported(Serializer) -> bool:
     return _key(Serializer) in __serializers
 
 
+@lru_cache(maxsize=None)
 def _key(Serializer):
     return '.'.join([Serializer.__module__, Serializer.__name__])
 
-def header(app, *middle):
+def source_hash(*sources):
+    """Hash the inputs a generated file is built from"""
+    digest = hashlib.blake2b(digest_size=8)
+    for source in sources:
+        if isinstance(source, str):
+            source = source.encode()
+        digest.update(source)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def is_generated_from(content, source):
+    """Check if the header of a generated file records this source hash"""
+    lines = content.split('\n', 2)
+    return len(lines) > 1 and f'[{source}]' in lines[1]
+
+
+def header(app, *middle, source=None):
     now = timezone.now().strftime('%Y-%m-%d %H:%M')
     tz = timezone.now().tzinfo
 
+    generated = f' * Generated by RxDjango on {now} ({tz})'
+    if source:
+        # Kept in the line with the date, which is ignored when comparing
+        generated += f' [{source}]'
+
     header = [
-        f' * Generated by RxDjango on {now} ({tz})',
+        generated,
     ] + [
         f' * {line}' for line in middle
     ]
@@ -83,6 +108,47 @@ def header(app, *middle):
     return code
 
 
+def read_header(ts_file_path):
+    """Read the two first lines of a generated file"""
+    with open(ts_file_path, 'r') as file:
+        return file.readline() + file.readline()
+
+
+def same_body(ts_file_path, content):
+    """Compare content with a generated file, reading it in chunks.
+    The first two lines hold the generation time and are ignored"""
+    body = content.split('\n', 2)[2] if content.count('\n') >= 2 else ''
+    position = 0
+    with open(ts_file_path, 'r') as file:
+        file.readline()
+        file.readline()
+        while True:
+            chunk = file.read(65536)
+            if not chunk:
+                return position == len(body)
+            if body[position:position + len(chunk)] != chunk:
+                return False
+            position += len(chunk)
+
+
+def read_lines(ts_file_path):
+    """Lines of a generated file, or an empty list if it does not exist"""
+    if not os.path.exists(ts_file_path):
+        return []
+    with open(ts_file_path, 'r') as file:
+        return file.read().split('\n')
+
+
+def write_file(ts_file_path, content):
+    try:
+        with open(ts_file_path, 'w') as fh:
+            fh.write(content)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(ts_file_path), exist_ok=True)
+        with open(ts_file_path, 'w') as fh:
+            fh.write(content)
+
+
 def diff(existing, content, filename):
     existing[0] = existing[1] = content[0] = content[1]
 
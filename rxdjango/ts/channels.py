@@ -1,12 +1,14 @@
 import os
 import re
-import json
-from collections import defaultdict
+import orjson
+from collections import defaultdict, deque
+from functools import lru_cache
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.urls import URLPattern, URLResolver
 from django.conf import settings
 from rxdjango.consumers import StateConsumer
-from . import header, interface_name, diff
+from . import (header, interface_name, diff, source_hash, is_generated_from,
+               read_header, same_body, read_lines, write_file)
 
 def create_app_channels(app, apply_changes=True):
     consumer_urlpatterns = list_consumer_patterns(app)
@@ -18,24 +20,27 @@ def create_app_channels(app, apply_changes=True):
     channel_path = channel_module_name.replace('.', '/') + '.py'
 
     ts_file_path = os.path.join(settings.RX_FRONTEND_DIR, f'{app}/{app}.channels.ts')
-    py_mtime = None
+    source = None
 
     if os.path.exists(channel_path):
-        py_mtime = os.path.getmtime(channel_path)
+        # Unlike the mtime, this survives touches and checkouts
+        with open(channel_path, 'rb') as file:
+            source = source_hash(
+                file.read(),
+                settings.ASGI_APPLICATION,
+                str(settings.RX_WEBSOCKET_URL),
+            )
 
+    exists = os.path.exists(ts_file_path)
 
-    existing = []
-
-    if os.path.exists(ts_file_path):
-        if py_mtime == os.path.getmtime(ts_file_path):
-            return
-        with open(ts_file_path, 'r') as file:
-            existing = file.read().split('\n')
+    if exists and source and is_generated_from(read_header(ts_file_path), source):
+        return
 
     code = header(
         app,
         f'Based on all ContextChannel.as_asgi() calls in {settings.ASGI_APPLICATION}',
         f'This is expected to match {app}/channels.py',
+        source=source,
     )
 
     code.extend([
@@ -43,16 +48,16 @@ def create_app_channels(app, apply_changes=True):
         f'const SOCKET_URL = {settings.RX_WEBSOCKET_URL};',
     ])
 
-    import_types = defaultdict(list)
+    import_types = defaultdict(dict)
     body = []
 
-    for urlpattern in consumer_urlpatterns:
+    for prefix, urlpattern in consumer_urlpatterns:
         consumer_class = urlpattern.callback.consumer_class
         context_channel_class = consumer_class.context_channel_class
         class_name = context_channel_class.__name__
-        class_code = generate_ts_class(context_channel_class, urlpattern, import_types)
+        class_code = generate_ts_class(context_channel_class, urlpattern, import_types, prefix)
         body.append('\n')
-        body.extend(class_code)
+        body.append(class_code)
 
     if not body:
         return
@@ -63,30 +68,23 @@ def create_app_channels(app, apply_changes=True):
 
     content = '\n'.join(code)
 
-    if content.split('\n')[2:] == existing[2:]:
-        if py_mtime:
-            os.utime(ts_file_path, (py_mtime, py_mtime))
+    if exists and same_body(ts_file_path, content):
+        if apply_changes and source:
+            # Record the new source hash, so next run returns early
+            write_file(ts_file_path, content)
         return
 
-    difference = diff(existing, content.split('\n'), ts_file_path)
+    difference = diff(read_lines(ts_file_path), content.split('\n'), ts_file_path)
 
     if not apply_changes:
         return difference
 
-    try:
-        with open(ts_file_path, 'w') as fh:
-            fh.write(content)
-    except FileNotFoundError:
-        os.makedirs(os.path.dirname(ts_file_path), exist_ok=True)
-        with open(ts_file_path, 'w') as fh:
-            fh.write(content)
-
-    if py_mtime:
-        os.utime(ts_file_path, (py_mtime, py_mtime))
+    write_file(ts_file_path, content)
 
     return difference
 
 
+@lru_cache(maxsize=1)
 def get_root_routing():
     asgi_app = settings.ASGI_APPLICATION
     module_name, app_name = asgi_app.rsplit('.', 1)
@@ -94,77 +92,93 @@ def get_root_routing():
     return getattr(module, app_name)
 
 
-def list_consumer_patterns(app_name, pattern_list=None, router=None):
+def list_consumer_patterns(app_name):
     """
-    Function to extract WebSocket consumers from the root routing (or provided router)
-    for a specific app that extends the StateConsumer class.
+    Function to extract WebSocket consumers from the root routing
+    for a specific app that extends the StateConsumer class, as
+    (prefix, pattern) tuples. The prefix comes from enclosing routers.
     """
+    return _consumer_patterns_by_app().get(app_name, [])
+
+
+@lru_cache(maxsize=1)
+def _consumer_patterns_by_app():
+    """Walk the root routing once, grouping consumer patterns by app"""
+    patterns = defaultdict(list)
+    routers = deque([(get_root_routing(), '')])
 
-    if pattern_list is None:
-        pattern_list = []
-        router = get_root_routing()
+    while routers:
+        router, prefix = routers.popleft()
 
-    if isinstance(router, ProtocolTypeRouter):
-        # Extract the websocket routing
-        websocket_router = router.application_mapping.get('websocket', None)
-        if websocket_router:
-            list_consumer_patterns(app_name, pattern_list, websocket_router)
+        if isinstance(router, ProtocolTypeRouter):
+            # Extract the websocket routing
+            websocket_router = router.application_mapping.get('websocket', None)
+            if websocket_router:
+                routers.append((websocket_router, prefix))
+            continue
+
+        if not isinstance(router, URLRouter):
+            continue
 
-    elif isinstance(router, URLRouter):
         for route in router.routes:
             callback = route.callback
+
+            if isinstance(callback, URLRouter):
+                # Nested URLRouter objects
+                routers.append((callback, prefix + str(route.pattern)))
+                continue
+
             if not hasattr(callback, 'consumer_class') or \
                not issubclass(callback.consumer_class, StateConsumer):
                 continue
 
             context_channel_class =  callback.consumer_class.context_channel_class
+            app_name = context_channel_class.__module__.split('.')[0]
+            patterns[app_name].append((prefix, route))
 
-            if context_channel_class.__module__.startswith(f'{app_name}.'):
-                pattern_list.append(route)
+    return patterns
 
-            elif isinstance(route, URLRouter):
-                # Recursive exploration for nested URLRouter objects
-                list_consumer_patterns(app_name, pattern_list, route)
 
-    return pattern_list
+# Matches path converters such as <int:project_id>
+_PARAM_RE = re.compile(r'<(\w+?):(\w+?)>')
 
+# Basic mapping from Django path converters to TypeScript types
+_TYPE_MAPPING = {
+    'str': 'string',
+    'int': 'number',
+    'slug': 'string',
+    'uuid': 'string',
+    'path': 'string',
+    # Add more if needed
+}
 
-def pattern_to_ts(urlpattern):
-    pattern_str = str(urlpattern.pattern)
 
-    # Extract key-type pairs
-    matches = re.findall(r'<(\w+?):(\w+?)>', pattern_str)
+def pattern_to_ts(urlpattern, prefix=''):
+    pattern_str = prefix + str(urlpattern.pattern)
 
-    # Basic mapping from Django path converters to TypeScript types
-    type_mapping = {
-        'str': 'string',
-        'int': 'number',
-        'slug': 'string',
-        'uuid': 'string',
-        'path': 'string',
-        # Add more if needed
-    }
+    # Extract key-type pairs
+    matches = _PARAM_RE.findall(pattern_str)
 
-    parameters = {key: type_mapping.get(type_, 'any') for type_, key in matches}
+    parameters = {key: _TYPE_MAPPING.get(type_, 'any') for type_, key in matches}
 
     # Convert Django pattern to a format easier to process in JS
-    endpoint = re.sub(r'<(\w+?):(\w+?)>', r'{\2}', pattern_str)
+    endpoint = _PARAM_RE.sub(r'{\2}', pattern_str)
 
     return endpoint, parameters
 
 def build_imports(serializers, this_app):
     code = []
     for app, app_serializers in serializers.items():
-        interfaces = [ interface_name(seri) for seri in app_serializers ]
+        interfaces = [ interface_name(seri) for seri in app_serializers.values() ]
         interfaces = ', '.join(sorted(interfaces))
         path = '.' if app == this_app else f'../{app}'
         code.append(f"import {{ {interfaces} }} from '{path}/{app}.interfaces.d';")
 
     return code
 
-def generate_ts_class(context_channel_class, urlpattern, import_types):
+def generate_ts_class(context_channel_class, urlpattern, import_types, prefix=''):
     # First, we get the endpoint pattern and the parameters from our previous function
-    endpoint, parameters = pattern_to_ts(urlpattern)
+    endpoint, parameters = pattern_to_ts(urlpattern, prefix)
 
     name = context_channel_class.__name__
     anchor = context_channel_class.Meta.state
@@ -174,43 +188,44 @@ def generate_ts_class(context_channel_class, urlpattern, import_types):
     app = anchor_module.split('.')[0]
     state_type = interface_name(anchor.__class__)
 
-    import_types[app].append(anchor.__class__)
+    # Several channels may share an anchor, import it once
+    import_types[app][id(anchor.__class__)] = anchor.__class__
 
     if getattr(anchor, 'many', False):
         state_type += '[]'
 
-    # Base of the class
-    code = [
-        f"export class {name} extends ContextChannel<{state_type}> {{\n",
-        f"  anchor = '{anchor_module}.{anchor_name}';",
-        f"  endpoint: string = '{endpoint}';\n",
-        f"  args: {{ [key: string]: number | string }} = {{}};\n",
-    ]
-
     # Add private properties based on parameters
     # for key, ts_type in parameters.items():
     #     code.append(f"  {key}: {ts_type};")
 
-    code.append(f'  baseURL: string = SOCKET_URL;\n')
-
     # Constructor
     params = ', '.join([f"{key}: {ts_type}"
                         for key, ts_type in parameters.items()])
 
     params = f'{params}, token: string' if params else 'token: string'
 
-    code.append(f"  constructor({params}) {{")
-    code.append(f"    super(token);")
-    code.extend([f"    this.args['{key}'] = {key};" for key in parameters])
-    code.append(f"  }}")
+    args = ''.join([f"\n    this.args['{key}'] = {key};" for key in parameters])
 
-    code.append('')
+    return f"""export class {name} extends ContextChannel<{state_type}> {{
 
-    model = context_channel_class._state_model.frontend_model()
-    model_code = json.dumps(model, indent=2)
-    indented = "\n".join("  " + line for line in model_code.splitlines())
-    code.append(f'  model = {indented[2:]};')
+  anchor = '{anchor_module}.{anchor_name}';
+  endpoint: string = '{endpoint}';
 
-    code.append(f"}}")
+  args: {{ [key: string]: number | string }} = {{}};
 
-    return code
+  baseURL: string = SOCKET_URL;
+
+  constructor({params}) {{
+    super(token);{args}
+  }}
+
+  model = {_model_code(context_channel_class)};
+}}"""
+
+
+@lru_cache(maxsize=None)
+def _model_code(context_channel_class):
+    """The frontend model of a channel as TS code, indented for the class body"""
+    model = context_channel_class._state_model.frontend_model()
+    model_code = orjson.dumps(model, option=orjson.OPT_INDENT_2)
+    return model_code.replace(b'\n', b'\n  ').decode()
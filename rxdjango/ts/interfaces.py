@@ -1,33 +1,37 @@
 import os
 import types
 import typing
+import inspect
 import importlib
+from collections import defaultdict
+from functools import lru_cache
 from decimal import Decimal
 from datetime import datetime
 from django.utils import timezone
 from django.db.models.query import QuerySet
 from django.db.models.fields import related_descriptors
+from django.apps import apps as django_apps
 from django.conf import settings
 from rest_framework import serializers, relations, fields
-from . import ts_exported, header, interface_name, diff
+from . import (ts_exported, header, interface_name, diff, source_hash,
+               is_generated_from, read_header, same_body, read_lines, write_file)
 
 def create_app_interfaces(app, apply_changes=True):
     serializer_module_name = f'{app}.serializers'
     serializer_path = serializer_module_name.replace('.', '/') + '.py'
 
     ts_file_path = os.path.join(settings.RX_FRONTEND_DIR, f'{app}/{app}.interfaces.d.ts')
-    py_mtime = None
+    source = None
 
     if os.path.exists(serializer_path):
-        py_mtime = os.path.getmtime(serializer_path)
+        # Unlike the mtime, this survives touches and checkouts
+        source = _sources_hash()
 
-    existing = []
+    exists = os.path.exists(ts_file_path)
 
-    if os.path.exists(ts_file_path):
-        if py_mtime == os.path.getmtime(ts_file_path):
-            return
-        with open(ts_file_path, 'r') as file:
-            existing = file.read().split('\n')
+    # Checked before importing the serializers and all their dependencies
+    if exists and source and is_generated_from(read_header(ts_file_path), source):
+        return
 
     try:
         module = importlib.import_module(serializer_module_name)
@@ -36,14 +40,14 @@ def create_app_interfaces(app, apply_changes=True):
 
     serializers = get_serializers(module)
 
-    try:
-        module_serializers = serializers.pop(app)
-    except KeyError:
+    module_serializers = serializers.pop(app, None)
+    if module_serializers is None:
         return
 
     code = header(
         app,
         f'Based on {app}/serializers.py',
+        source=source,
     )
 
     initial_length = len(code)
@@ -76,45 +80,64 @@ def create_app_interfaces(app, apply_changes=True):
 
     content = '\n'.join(code)
 
-    if content.split('\n')[2:] == existing[2:]:
+    if exists and same_body(ts_file_path, content):
+        if apply_changes and source:
+            # Record the new source hash, so next run returns early
+            write_file(ts_file_path, content)
         return
 
-    difference = diff(existing, content.split('\n'), ts_file_path)
+    difference = diff(read_lines(ts_file_path), content.split('\n'), ts_file_path)
     if not apply_changes:
         return difference
 
-    try:
-        with open(ts_file_path, 'w') as fh:
-            fh.write(content)
-    except FileNotFoundError:
-        os.makedirs(os.path.dirname(ts_file_path), exist_ok=True)
-        with open(ts_file_path, 'w') as fh:
-            fh.write(content)
-
-    if py_mtime:
-        os.utime(ts_file_path, (py_mtime, py_mtime))
+    write_file(ts_file_path, content)
 
     return difference
 
 
+@lru_cache(maxsize=1)
+def _sources_hash():
+    """Hash every file the interfaces may depend on. Field types,
+    properties and annotations come from models, and serializers may
+    nest other apps' serializers, so models and serializers of all
+    installed apps are included"""
+    contents = []
+    for path in _source_files():
+        with open(path, 'rb') as file:
+            contents += [path, file.read()]
+    return source_hash(*contents)
+
+
+def _source_files():
+    paths = []
+    for config in django_apps.get_app_configs():
+        for name in ('models', 'serializers'):
+            module_path = os.path.join(config.path, name)
+            if os.path.isdir(module_path):
+                for root, dirs, files in os.walk(module_path):
+                    dirs.sort()
+                    paths += [
+                        os.path.join(root, f) for f in sorted(files)
+                        if f.endswith('.py')
+                    ]
+            elif os.path.exists(f'{module_path}.py'):
+                paths.append(f'{module_path}.py')
+    return paths
+
+
 def get_serializers(module):
-    apps = {}
+    apps = defaultdict(list)
 
     for klass in _get_serializer_classes(module):
         app = klass.__module__.split('.')[0]
-        try:
-            apps[app].append(klass)
-        except KeyError:
-            apps[app] = [klass]
-    return apps
+        apps[app].append(klass)
+    return dict(apps)
 
 def _get_serializer_classes(module):
     for name, klass in module.__dict__.items():
-        try:
-            if issubclass(klass, serializers.Serializer):
-                yield klass
-        except TypeError:
-            pass
+        # Most module members are not classes, skip them without raising
+        if isinstance(klass, type) and issubclass(klass, serializers.Serializer):
+            yield klass
 
 mappings = {
     serializers.BooleanField: 'boolean',
@@ -137,6 +160,11 @@ mappings = {
     relations.PrimaryKeyRelatedField: 'number',
 }
 
+# Same as mappings, for fields with many values
+mappings_many = {
+    field_type: f'{ts_type}[]' for field_type, ts_type in mappings.items()
+}
+
 
 def __process_field(field_name, field, serializer):
     '''
@@ -152,27 +180,28 @@ def __process_field(field_name, field, serializer):
         is_many = False
         field_type = type(field)
 
-    ts_type = mappings.get(field_type)
-
-    if not ts_type:
-        if hasattr(field, 'choices'):
-            ts_type = __map_choices_to_union(field_type, field.choices)
-        elif field_type is fields.ReadOnlyField:
-            model_field = getattr(serializer.Meta.model, field_name)
-            if isinstance(model_field,
-                          related_descriptors.ForeignKeyDeferredAttribute):
-                ts_type = 'number'
-            else:
-                func = model_field
-                if type(model_field) is property:
-                    func = func.fget
-                ts_type = __get_function_type(func)
+    ts_type = (mappings_many if is_many else mappings).get(field_type)
+    if ts_type:
+        return (field_name, ts_type)
+
+    if hasattr(field, 'choices'):
+        ts_type = __map_choices_to_union(field_type, field.choices)
+    elif field_type is fields.ReadOnlyField:
+        model_field = getattr(serializer.Meta.model, field_name)
+        if isinstance(model_field,
+                      related_descriptors.ForeignKeyDeferredAttribute):
+            ts_type = 'number'
+        else:
+            func = model_field
+            if type(model_field) is property:
+                func = func.fget
+            ts_type = __get_function_type(func)
 
+    else:
+        if field_type.__name__.endswith('Serializer'):
+            ts_type = interface_name(field_type)
         else:
-            if field_type.__name__.endswith('Serializer'):
-                ts_type = interface_name(field_type)
-            else:
-                ts_type = 'any'
+            ts_type = 'any'
 
 
     if is_many:
@@ -180,23 +209,29 @@ def __process_field(field_name, field, serializer):
 
     return (field_name, ts_type)
 
+PY_TO_TS = {
+    int: 'number',
+    float: 'number',
+    Decimal: 'number',
+    datetime: 'string',
+    str: 'string',
+    bool: 'boolean',
+    type(None): 'null',
+    QuerySet: 'number[]',
+}
+
+
+@lru_cache(maxsize=None)
 def __get_function_type(func):
-    hints = typing.get_type_hints(func)
+    # Annotations are evaluated once per function, the same property
+    # is reached from every serializer that exposes it
+    hints = inspect.get_annotations(func, eval_str=True)
     try:
         ftype = hints['return']
     except KeyError:
         return 'any'
-
-    PY_TO_TS = {
-        int: 'number',
-        float: 'number',
-        Decimal: 'number',
-        datetime: 'string',
-        str: 'string',
-        bool: 'boolean',
-        type(None): 'null',
-        QuerySet: 'number[]',
-    }
+    if ftype is None:
+        ftype = type(None)
 
     if type(ftype) is types.UnionType :
         py_types = typing.get_args(ftype)
@@ -213,7 +248,11 @@ def __map_choices_to_union(field_type, choices):
     if not choices:
         return 'any'
 
-    return ' | '.join(f'"{key}"' if type(key) == str else str(key) for key in choices.keys())
+    return ' | '.join(map(__format_choice, choices.keys()))
+
+
+def __format_choice(key):
+    return f'"{key}"' if type(key) == str else str(key)
 
 
 def serialize_type(serializer):
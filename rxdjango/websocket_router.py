@@ -1,4 +1,4 @@
-import json
+import asyncio
 from asgiref.sync import async_to_sync
 import channels.layers
 from rxdjango.serialize import json_dumps
@@ -9,6 +9,9 @@ SYSTEM_CHANNEL = getattr(
     settings, 'RXDJANGO_SYSTEM_CHANNEL', '_rxdjango_system'
 )
 
+# Seconds that a dispatch from sync code may wait for the channel layer
+DISPATCH_TIMEOUT = getattr(settings, 'RXDJANGO_DISPATCH_TIMEOUT', 10)
+
 
 def get_channel_key(name, anchor_id, user_id=None):
     if user_id is None:
@@ -16,6 +19,18 @@ def get_channel_key(name, anchor_id, user_id=None):
     return f'{name}_{anchor_id}_{user_id}'
 
 
+def run_sync(async_function, *args):
+    """Run a coroutine function from sync code and wait for the result.
+    A channel layer that doesn't answer fails the call after
+    RXDJANGO_DISPATCH_TIMEOUT seconds instead of blocking the thread
+    that fired the signal"""
+    return async_to_sync(_run_with_timeout)(async_function, *args)
+
+
+async def _run_with_timeout(async_function, *args):
+    return await asyncio.wait_for(async_function(*args), DISPATCH_TIMEOUT)
+
+
 async def send_system_message(source, message):
     channel_layer = channels.layers.get_channel_layer()
     payload = {
@@ -35,56 +50,81 @@ class WebsocketRouter:
 
     def __init__(self, name):
         self.name = name
+        # Same keys as get_channel_key(), with the name part built once
+        self._prefix = f'{name}_'
+
+    def channel_key(self, anchor_id, user_id=None):
+        if user_id is None:
+            return self._prefix + str(anchor_id)
+        return f'{self._prefix}{anchor_id}_{user_id}'
 
     async def connect(self, channel_layer, channel_name, anchor_id, user_id):
-        # Join room group
-        await channel_layer.group_add(
-            get_channel_key(self.name, anchor_id),
-            channel_name,
+        # The three groups are independent, join them concurrently
+        await asyncio.gather(
+            # Join room group
+            channel_layer.group_add(
+                self.channel_key(anchor_id),
+                channel_name,
+            ),
+            # Join this user room group, so that user-specific
+            # data is shared
+            channel_layer.group_add(
+                self.channel_key(anchor_id, user_id),
+                channel_name,
+            ),
+            # Connect to the system channel
+            channel_layer.group_add(SYSTEM_CHANNEL, channel_name),
         )
 
-        # Join this user room group, so that user-specific
-        # data is shared
-        await channel_layer.group_add(
-            get_channel_key(self.name, anchor_id, user_id),
-            channel_name,
-        )
+    def sync_dispatch(self, payload, anchor_id, user_id=None):
+        run_sync(self.dispatch, payload, anchor_id, user_id)
 
-        # Connect to the system channel
-        await channel_layer.group_add(SYSTEM_CHANNEL, channel_name)
+    def sync_dispatch_many(self, dispatches):
+        """Send several (payload, anchor_id, user_id) tuples entering the
+        event loop only once"""
+        if dispatches:
+            run_sync(self.dispatch_many, dispatches)
 
-    def sync_dispatch(self, payload, anchor_id, user_id=None):
-        async_to_sync(self.dispatch)(payload, anchor_id, user_id)
+    async def dispatch_many(self, dispatches):
+        await asyncio.gather(*[
+            self.dispatch(payload, anchor_id, user_id)
+            for payload, anchor_id, user_id in dispatches
+        ])
 
     async def dispatch(self, payload, anchor_id, user_id=None):
-        channel_key = get_channel_key(self.name, anchor_id, user_id)
+        channel_key = self.channel_key(anchor_id, user_id)
         channel_layer = channels.layers.get_channel_layer()
 
-        # FIXME: Datetime fields should be handled prior to this
-        payload = json_dumps(payload)
-        payload = json.loads(payload)
+        # Encoded once here instead of once by each consumer in the group
+        text = json_dumps(payload)
 
         await channel_layer.group_send(
             channel_key,
             {
                 'type': 'relay',
-                'payload': payload,
+                'text': text,
             },
         )
 
     async def disconnect(self, channel_layer, channel_name, anchor_id, user_id=None):
         # Leave the room group
-        await channel_layer.group_discard(
-            get_channel_key(self.name, anchor_id),
-            channel_name,
-        )
+        discards = [
+            channel_layer.group_discard(
+                self.channel_key(anchor_id),
+                channel_name,
+            ),
+        ]
 
         # Leave this user room group
         if user_id is not None:
-            await channel_layer.group_discard(
-                get_channel_key(self.name, anchor_id, user_id),
-                channel_name,
+            discards.append(
+                channel_layer.group_discard(
+                    self.channel_key(anchor_id, user_id),
+                    channel_name,
+                ),
             )
 
         # Leave the system channel
-        await channel_layer.group_discard(SYSTEM_CHANNEL, channel_name)
+        discards.append(channel_layer.group_discard(SYSTEM_CHANNEL, channel_name))
+
+        await asyncio.gather(*discards)
@@ -20,6 +20,7 @@ setup(
         'djangorestframework>=3',
         'daphne>=4.1.0',
         'pytz',
+        'orjson>=3.6',
     ],
     url="https://github.com/CDIGlobalTrack/rxdjango",
     include_package_data=True,
@@ -0,0 +1,22 @@
+import django
+from django.conf import settings
+
+
+settings.configure(
+    INSTALLED_APPS=['tests.testapp'],
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        },
+    },
+    DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+    MONGO_URL='mongodb://localhost:27017',
+    MONGO_STATE_DB='rxdjango_test',
+    REDIS_URL='redis://localhost:6379',
+    TESTING=True,
+)
+django.setup()
+
+from django.db import connection  # noqa: E402
+connection.creation.create_test_db(verbosity=0)
@@ -0,0 +1,196 @@
+import itertools
+from unittest import mock
+from django.db import transaction
+from django.db.models.signals import pre_delete
+from django.test import TransactionTestCase
+from rxdjango import signal_handler
+from rxdjango.signal_handler import SignalHandler
+from rxdjango.state_model import StateModel
+from .testapp.models import Customer, Project, Task
+from .testapp.serializers import ProjectSerializer
+
+
+class ProjectChannel:
+    name = 'test_project'
+    _state_model = StateModel(ProjectSerializer())
+    _wsrouter = None
+
+
+# Layers are connected without setup(), which also clears the cache
+# databases after every migrate
+handler = SignalHandler(ProjectChannel)
+for layer in ProjectChannel._state_model.models():
+    handler._connect_layer(layer)
+
+PROJECT = ProjectChannel._state_model.instance_type
+TASK = ProjectChannel._state_model['tasks'].instance_type
+
+
+class SignalHandlerTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.sent = []
+        tstamps = itertools.count(1)
+        patches = [
+            mock.patch.object(handler, '_schedule', self.sent.extend),
+            mock.patch.object(signal_handler, 'sync_get_tstamp',
+                              lambda: float(next(tstamps))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def relayed(self, instance_type, operation):
+        return [
+            serialized for serialized, anchor_ids in self.sent
+            if serialized['_instance_type'] == instance_type
+            and serialized['_operation'] == operation
+        ]
+
+
+class ReparentTestCase(SignalHandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.a = Project.objects.create(name='a')
+        self.b = Project.objects.create(name='b')
+        Task.objects.create(name='t', project=self.a)
+        self.sent.clear()
+
+    def updated_projects(self):
+        return sorted(p['id'] for p in self.relayed(PROJECT, 'update'))
+
+    def test_new_and_old_parent_are_relayed(self):
+        task = Task.objects.get(name='t')
+        task.project = self.b
+        task.save()
+        self.assertEqual(self.updated_projects(), [self.a.id, self.b.id])
+
+    def test_same_parent_is_not_relayed(self):
+        task = Task.objects.get(name='t')
+        task.name = 'u'
+        task.save()
+        self.assertEqual(self.updated_projects(), [])
+        self.assertEqual(len(self.relayed(TASK, 'update')), 1)
+
+    def test_saved_parent_is_not_queried_again(self):
+        task = Task.objects.get(name='t')
+        task.save()
+        with self.assertNumQueries(1):
+            task.save()
+
+    def test_rolled_back_parent_is_not_trusted(self):
+        task = Task.objects.get(name='t')
+        task.save()
+        try:
+            with transaction.atomic():
+                task.project = self.b
+                task.save()
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.sent.clear()
+        # Still under a in the database
+        task.save()
+        self.assertEqual(self.updated_projects(), [self.a.id, self.b.id])
+
+    def test_broadcast_does_not_hide_a_reparent(self):
+        task = Task.objects.get(name='t')
+        task.project = self.b
+        handler.broadcast_instance(self.a.id, task)
+        self.sent.clear()
+        task.save()
+        self.assertEqual(self.updated_projects(), [self.a.id, self.b.id])
+
+
+class DeleteTestCase(SignalHandlerTestCase):
+
+    def deleted_tstamps(self, instance_type):
+        return [d['_tstamp'] for d in self.relayed(instance_type, 'delete')]
+
+    def test_cascade_shares_tstamp(self):
+        project = Project.objects.create(name='p')
+        Task.objects.create(name='t1', project=project)
+        Task.objects.create(name='t2', project=project)
+        self.sent.clear()
+        project.delete()
+        tstamps = self.deleted_tstamps(PROJECT) + self.deleted_tstamps(TASK)
+        self.assertEqual(len(tstamps), 3)
+        self.assertEqual(len(set(tstamps)), 1)
+        self.assertEqual(len(signal_handler._deletions), 0)
+
+    def test_reused_queryset_gets_a_new_tstamp(self):
+        project = Project.objects.create(name='p')
+        tasks = Task.objects.filter(project=project)
+        Task.objects.create(name='t1', project=project)
+        tasks.delete()
+        Task.objects.create(name='t2', project=project)
+        tasks.delete()
+        first, second = self.deleted_tstamps(TASK)
+        self.assertNotEqual(first, second)
+
+    def test_failed_delete_does_not_leak_into_retry(self):
+        task = Task.objects.create(name='t', project=Project.objects.create(name='p'))
+        failures = [RuntimeError()]
+
+        def fail(sender, instance, **kwargs):
+            if failures:
+                raise failures.pop()
+
+        pre_delete.connect(fail, sender=Task)
+        self.addCleanup(pre_delete.disconnect, fail, sender=Task)
+        with self.assertRaises(RuntimeError):
+            task.delete()
+        self.sent.clear()
+        task.delete()
+        tstamps = self.deleted_tstamps(TASK)
+        self.assertEqual(len(tstamps), 1)
+        self.assertNotEqual(tstamps[0], 1.0)
+        self.assertEqual(len(signal_handler._deletions), 0)
+
+
+class CreateTestCase(SignalHandlerTestCase):
+
+    def test_children_are_relayed_without_leaving_prefetch_caches(self):
+        customer = Customer.objects.create(name='c')
+        project = Project(name='p', customer=customer)
+        project.save()
+        self.assertEqual(len(self.relayed(PROJECT, 'create')), 1)
+        Task.objects.create(name='t', project=project)
+        # Querysets of the saved objects are not served from a cache
+        # filled when they were created
+        self.assertEqual([t.name for t in project.tasks.all()], ['t'])
+        self.assertEqual(list(customer.projects.all()), [project])
+
+
+class RelayTestCase(SignalHandlerTestCase):
+
+    def test_payloads_are_grouped_by_anchor_and_user(self):
+        a = Project.objects.create(name='a')
+        b = Project.objects.create(name='b')
+        task = Task.objects.create(name='t', project=a)
+        layer = handler.state_model['tasks']
+        unresolved = layer.serialize_instance(task, 1.0)
+        shared = layer.serialize_instance(task, 2.0)
+        private = {**shared, '_user_key': 7}
+        batch = [
+            (unresolved, None),
+            (shared, [a.id, b.id]),
+            (private, [a.id]),
+        ]
+        mongo = mock.Mock()
+        mongo.write_instances.side_effect = lambda anchor_id, payload: payload
+        wsrouter = mock.Mock()
+        with mock.patch.object(handler, 'mongo', mongo), \
+             mock.patch.object(handler, 'wsrouter', wsrouter):
+            handler._relay(batch)
+        self.assertEqual(mongo.write_instances.call_args_list, [
+            mock.call(a.id, [unresolved, shared]),
+            mock.call(b.id, [shared]),
+            mock.call(a.id, [private]),
+        ])
+        wsrouter.sync_dispatch_many.assert_called_once_with([
+            ([unresolved, shared], a.id, None),
+            ([shared], b.id, None),
+            ([private], a.id, 7),
+        ])
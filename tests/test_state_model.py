@@ -0,0 +1,65 @@
+from django.db import ProgrammingError
+from django.db.models import Prefetch
+from django.test import TestCase
+from rest_framework import serializers
+from rxdjango.state_model import StateModel
+from .testapp.models import Board, Card, Project
+from .testapp.serializers import BoardSerializer, TaskSerializer
+
+
+class GetAnchorsBulkTestCase(TestCase):
+
+    def setUp(self):
+        self.state_model = StateModel(BoardSerializer())
+        self.cards = self.state_model['cards']
+
+    def test_uuid_ids_match_serialized_ids(self):
+        board = Board.objects.create(name='b')
+        other = Board.objects.create(name='o')
+        card = Card.objects.create(board=board)
+        serialized = [
+            self.cards.serialize_instance(card, 1.0),
+            self.state_model.serialize_instance(other, 1.0),
+        ]
+        # Serializers render UUIDs as strings
+        self.assertIsInstance(serialized[0]['id'], str)
+        self.assertEqual(
+            self.state_model.get_anchors_bulk(serialized),
+            [[board.id], [other.id]],
+        )
+
+    def test_unknown_ids_have_no_anchors(self):
+        card = Card.objects.create(board=Board.objects.create(name='b'))
+        serialized = self.cards.serialize_delete(card, 1.0)
+        card.delete()
+        self.assertEqual(self.state_model.get_anchors_bulk([serialized]), [[]])
+
+
+class PrefetchRelatedTestCase(TestCase):
+
+    def build(self, lookups):
+        class ProjectSerializer(serializers.ModelSerializer):
+            tasks = TaskSerializer(many=True)
+
+            class Meta:
+                model = Project
+                fields = ['id', 'name', 'tasks']
+                prefetch_related = lookups
+
+        return StateModel(ProjectSerializer())
+
+    def test_lookups_are_added_to_many_prefetch(self):
+        lookup = Prefetch('customer__projects')
+        state_model = self.build(['tasks__owner', lookup])
+        self.assertEqual(
+            state_model.many_prefetch,
+            ('tasks', 'tasks__owner', lookup),
+        )
+
+    def test_wrong_lookup_is_rejected(self):
+        with self.assertRaisesMessage(ProgrammingError, 'Task has no attribute "ownr"'):
+            self.build(['tasks__ownr'])
+
+    def test_string_is_rejected(self):
+        with self.assertRaises(ProgrammingError):
+            self.build('tasks__owner')
@@ -0,0 +1,27 @@
+import uuid
+from django.db import models
+
+
+class Customer(models.Model):
+    name = models.CharField(max_length=50)
+
+
+class Project(models.Model):
+    name = models.CharField(max_length=50)
+    customer = models.ForeignKey(Customer, null=True, on_delete=models.CASCADE, related_name='projects')
+
+
+class Task(models.Model):
+    name = models.CharField(max_length=50)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='tasks')
+    owner = models.ForeignKey(Customer, null=True, on_delete=models.SET_NULL)
+
+
+class Board(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    name = models.CharField(max_length=50)
+
+
+class Card(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    board = models.ForeignKey(Board, on_delete=models.CASCADE, related_name='cards')
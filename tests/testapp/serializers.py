@@ -0,0 +1,39 @@
+from rest_framework import serializers
+from .models import Customer, Project, Task, Board, Card
+
+
+class CustomerSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Customer
+        fields = ['id', 'name']
+
+
+class TaskSerializer(serializers.ModelSerializer):
+    owner = CustomerSerializer()
+
+    class Meta:
+        model = Task
+        fields = ['id', 'name', 'owner']
+
+
+class ProjectSerializer(serializers.ModelSerializer):
+    customer = CustomerSerializer()
+    tasks = TaskSerializer(many=True)
+
+    class Meta:
+        model = Project
+        fields = ['id', 'name', 'customer', 'tasks']
+
+
+class CardSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Card
+        fields = ['id']
+
+
+class BoardSerializer(serializers.ModelSerializer):
+    cards = CardSerializer(many=True)
+
+    class Meta:
+        model = Board
+        fields = ['id', 'name', 'cards']